@@ -1,53 +1,40 @@
 #!/usr/bin/env python3
 
+import argparse
 import sys
+from contextlib import ExitStack
 from uuid import uuid4
 
 from pychroot import Chroot
-from lib.debootstrap import debootstrap
+from lib.common import run_parallel
+from lib.debootstrap import debootstrap, dpkg_unsafe_io, find_mirror
 from lib.system import *
 from lib.network import *
 from lib.disk import (
-    dd,
-    losetup_create,
+    create_sparse_file,
+    dig_holes,
+    loop_device,
     losetup_delete,
-    create_partition_table,
-    create_partition,
+    get_loop_devices,
+    partition_disk,
+    wait_for_devices,
     format_partition,
-    mount_device,
-    unmount_device,
+    mounted,
     get_partition_uuid
 )
 
 LOG_FMT_MSG = "[%(asctime)s][%(levelname)s] %(message)s"
 LOG_FMT_DATE = "%H:%M:%S %Y-%m-%d"
-
-PKG_KERNEL = "linux-image-arm64"
-PKG_INCLUDES = [
-    "aptitude",
-    "dbus",
-    "dialog",
-    "dosfstools",
-    "firmware-brcm80211",
-    "firmware-realtek",
-    "iproute2",
-    "locales",
-    "parted",
-    "python-apt",       # For ansible
-    "python",           # For ansible
-    "python-selinux",   # For ansible
-    "raspi3-firmware",
-    "rng-tools5",
-    "systemd",
-    "systemd-sysv",
-    "ssh",
-    "vim",
-    "wireless-tools",
-    "wpasupplicant"
-]
+ENV_LOG_LEVEL = "LOGLEVEL"
+LOG_LEVEL_DEFAULT = "INFO"
 
 FILE_IMG_DEFAULT = "debian-stable-arm64.img"
+IMG_SIZE_DEFAULT = 2048
 PATH_MOUNT = "/mnt"
+# The image is only written while it's built, so there's no need for atime
+# updates or for journal barriers and commits that protect against a crash
+MNT_OPTS_ROOT = "noatime,nobarrier,commit=600,data=writeback"
+MNT_OPTS_BOOT = "noatime"
 FILE_STATUS = ".status"
 FILE_RESIZE_PART = "/usr/local/bin/expand-root-partition"
 
@@ -56,188 +43,194 @@ SCRIPT_RESIZE_ROOTFS = """
 
 parted -s /dev/mmcblk0p2 resizepart 1 100%
 resize2fs /dev/mmcblk0p2
-""".strip()
+""".lstrip()
+
+
+def positive_int(value):
+    """
+    argparse type for a whole number above zero
+    :param value: Command line value
+    :return: value as an int
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+def parse_args():
+    """
+    :return: Parsed command line arguments
+    """
+    parser = argparse.ArgumentParser(description="Create a custom Debian arm64 Raspberry Pi image")
+    parser.add_argument(
+        "--image",
+        default=FILE_IMG_DEFAULT,
+        help="Image file to create (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--image-size",
+        type=positive_int,
+        default=IMG_SIZE_DEFAULT,
+        help="Image size in megabytes (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--mount",
+        default=PATH_MOUNT,
+        help="Where to mount the image while it's built (default: %(default)s)"
+    )
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
+    img_file = args.image
+    mount_path = args.mount
+
+    log_level = os.environ.get(ENV_LOG_LEVEL, LOG_LEVEL_DEFAULT).upper()
+    # Names logging doesn't know come back as "Level <name>" rather than a number
+    level_known = isinstance(logging.getLevelName(log_level), int)
     logging.basicConfig(
         format=LOG_FMT_MSG,
         datefmt=LOG_FMT_DATE,
-        level="INFO"
+        level=log_level if level_known else LOG_LEVEL_DEFAULT
     )
+    if not level_known:
+        logging.warning("Unknown %s '%s', using %s", ENV_LOG_LEVEL, log_level, LOG_LEVEL_DEFAULT)
 
-    if os.path.exists(FILE_IMG_DEFAULT):
-        os.remove(FILE_IMG_DEFAULT)
-
-    # Create image file
-    logging.info("Creating {}...".format(FILE_IMG_DEFAULT))
-    if not dd("/dev/zero", FILE_IMG_DEFAULT, "1M", 2048):
-        logging.error("Failed to create {}. Exiting.".format(FILE_IMG_DEFAULT))
-        return 1
-
-    # Create a loop device from the image file
-    logging.info("Creating a loop device from {}...".format(FILE_IMG_DEFAULT))
-    loop_device = losetup_create(FILE_IMG_DEFAULT)
-    if loop_device is None:
-        logging.error("Failed to create a loop device from {}. Exiting.".format(FILE_IMG_DEFAULT))
-        return 1
-
-    # Create partition table
-    logging.info("Creating partition table on {}...".format(loop_device))
-    if not create_partition_table(loop_device):
-        logging.error("Failed to create partition table on {}. Exiting.".format(loop_device))
-        losetup_delete(loop_device)
-        return 1
-
-    # Create boot partition
-    logging.info("Creating boot partition {}...".format(loop_device))
-    if not create_partition(loop_device, "fat32", "0%", "256M"):
-        logging.error("Failed to create boot partition on {}. Exiting.".format(loop_device))
-        losetup_delete(loop_device)
-        return 1
-
-    # Create root partition
-    logging.info("Creating root partition {}...".format(loop_device))
-    if not create_partition(loop_device, "ext4", "256M", "100%"):
-        logging.error("Failed to create root partition on {}. Exiting.".format(loop_device))
-        losetup_delete(loop_device)
-        return 1
-
-    # Format boot partition
-    logging.info("Formatting boot partition...")
-    if not format_partition("{}p1".format(loop_device), "vfat"):
-        logging.error("Failed to format boot partition on {}. Exiting.".format(loop_device))
-        losetup_delete(loop_device)
-        return 1
-
-    # Format root partition
-    logging.info("Formatting root partition...")
-    if not format_partition("{}p2".format(loop_device), "ext4"):
-        logging.error("Failed to format root partition on {}. Exiting.".format(loop_device))
-        losetup_delete(loop_device)
-        return 1
-
-    # Get partition uuids
-    boot_partition_uuid = get_partition_uuid("{}p1".format(loop_device))
-    root_partition_uuid = get_partition_uuid("{}p2".format(loop_device))
+    # Detach the image left over from a previous run that didn't clean up
+    stale_loop_device = get_loop_devices().get(os.path.realpath(img_file))
+    if stale_loop_device is not None:
+        logging.info("Deleting stale loop device at %s...", stale_loop_device)
+        losetup_delete(stale_loop_device)
 
-    if boot_partition_uuid is None or root_partition_uuid is None:
-        logging.error("Failed to retrieve partition UUIDs. Exiting.".format(loop_device))
-        losetup_delete(loop_device)
-        return 1
+    try:
+        os.unlink(img_file)
+    except FileNotFoundError:
+        pass
 
-    # Mount the root partition
-    logging.info("Mounting root partition on {}...".format(PATH_MOUNT))
-    if not mount_device("UUID={}".format(root_partition_uuid), PATH_MOUNT):
-        logging.error("Failed to mount root partition. Exiting.")
-        losetup_delete(loop_device)
-        return 1
-
-    # Mount the boot partition
-    boot_mount_path = os.path.join(PATH_MOUNT, "boot", "firmware")
-    logging.info("Mounting boot partition on {}...".format(boot_mount_path))
-    os.makedirs(boot_mount_path, mode=0o755, exist_ok=True)
-    if not mount_device("UUID={}".format(boot_partition_uuid), boot_mount_path):
-        logging.error("Failed to mount boot partition. Exiting.")
-        unmount_device("UUID={}".format(root_partition_uuid))
-        losetup_delete(loop_device)
-        return 1
-
-    # Debootstrap
-    logging.info("Creating minimal debootstrap system at {}...".format(PATH_MOUNT))
-    if not debootstrap(PATH_MOUNT, extra_pks=PKG_INCLUDES, repo="http://localhost:8080/debian"):
-        logging.error("debootstrap failed for {}. Exiting.".format(PATH_MOUNT))
-        unmount_device("UUID={}".format(boot_partition_uuid))
-        unmount_device("UUID={}".format(root_partition_uuid))
-        losetup_delete(loop_device)
-        return 1
-
-    # System configuration
-    # TODO: Script keeps going if configuration fails, because cant pass variables btwn main script & chroot context
-    logging.info("Configuring system...")
-    with Chroot(PATH_MOUNT):
-        success = True
-
-        # Configure apt to use cache
-        if success and not configure_apt("http://localhost:8080/debian"):
-            logging.error("Failed to configure apt")
-            success = False
-
-        # Install kernel
-        if success and not install_kernel():
-            logging.error("Failed to install kernel".format(PATH_MOUNT))
-            success = False
-
-        # Write fstab
-        if success and not write_fstab(boot_partition_uuid, root_partition_uuid):
-            logging.error("Failed to write {}/etc/fstab".format(PATH_MOUNT))
-            success = False
-
-        # Change root password
-        if success and not change_rootpw("toor"):
-            logging.error("Failed to change root password")
-            success = False
-
-        # Configure locale
-        if success and not configure_locale("en_US.UTF-8"):
-            logging.error("Locale configuration failed")
-            success = False
-
-        # Configure keyboard
-        if success and not configure_keyboard("us"):
-            logging.error("Keyboard configuration failed")
-            success = False
-
-        # Configure vim
-        if success and not configure_vim():
-            logging.error("Vim configuration failed")
-            success = False
-
-        # Configure networking
-        if success and not configure_networking():
-            logging.error("Network configuration failed")
-            success = False
-
-        # Configure hostname
-        if success and not configure_hostname("raspberrypi"):
-            logging.error("Hostname configuration failed")
-            success = False
-
-        # Configure ssh
-        if success and not configure_sshd():
-            logging.error("SSHD configuration failed")
-            success = False
-
-        # Configure apt to use official repo
-        if success and not configure_apt():
-            logging.error("Failed to configure apt")
-            success = False
-
-        # Write a convenience script for resizing the root fs
-        if success and not write_file(FILE_RESIZE_PART, SCRIPT_RESIZE_ROOTFS):
-            success = False
-
-        if not success:
-            logging.error("System configuration failed.")
-
-    # Unmount the boot partition
-    logging.info("Umounting boot partition...")
-    if not unmount_device("UUID={}".format(boot_partition_uuid)):
-        logging.error("Failed to unmount boot partition. Exiting.")
-        unmount_device("UUID={}".format(root_partition_uuid))
+    # Create image file
+    logging.info("Creating %s...", img_file)
+    if not create_sparse_file(img_file, args.image_size):
+        logging.error("Failed to create %s. Exiting.", img_file)
         return 1
 
-    # Unmount the root partition
-    logging.info("Umounting root partition...")
-    if not unmount_device("UUID={}".format(root_partition_uuid)):
-        logging.error("Failed to unmount root partition. Exiting")
+    # Everything attached or mounted from here on is entered into the stack,
+    # which releases it in reverse order however the block is left
+    failed_releases = []
+    with ExitStack() as stack:
+        # Create a loop device from the image file
+        logging.info("Creating a loop device from %s...", img_file)
+        loop_dev = stack.enter_context(loop_device(img_file, failed_releases))
+        if loop_dev is None:
+            logging.error("Failed to create a loop device from %s. Exiting.", img_file)
+            return 1
+
+        # Create partition table with boot & root partitions
+        logging.info("Partitioning %s...", loop_dev)
+        if not partition_disk(loop_dev, [("fat32", "0%", "256M"), ("ext4", "256M", "100%")]):
+            logging.error("Failed to partition %s. Exiting.", loop_dev)
+            return 1
+
+        boot_partition = "{}p1".format(loop_dev)
+        root_partition = "{}p2".format(loop_dev)
+        if not wait_for_devices([boot_partition, root_partition]):
+            logging.error("Partitions of %s didn't appear. Exiting.", loop_dev)
+            return 1
+
+        # Format boot & root partitions; they don't overlap so mkfs can run on both at once
+        logging.info("Formatting boot and root partitions...")
+        boot_formatted, root_formatted = run_parallel([
+            (format_partition, (boot_partition, "vfat")),
+            (format_partition, (root_partition, "ext4"))
+        ])
+
+        if not boot_formatted:
+            logging.error("Failed to format boot partition on %s. Exiting.", loop_dev)
+            return 1
+
+        if not root_formatted:
+            logging.error("Failed to format root partition on %s. Exiting.", loop_dev)
+            return 1
+
+        # Get partition uuids for fstab
+        boot_partition_uuid = get_partition_uuid(boot_partition)
+        root_partition_uuid = get_partition_uuid(root_partition)
+
+        if boot_partition_uuid is None or root_partition_uuid is None:
+            logging.error("Failed to retrieve partition UUIDs. Exiting.")
+            return 1
+
+        # Mount the root partition
+        logging.info("Mounting root partition on %s...", mount_path)
+        if not stack.enter_context(mounted(root_partition, mount_path, "ext4", MNT_OPTS_ROOT, failed_releases)):
+            logging.error("Failed to mount root partition. Exiting.")
+            return 1
+
+        # Mount the boot partition
+        boot_mount_path = os.path.join(mount_path, "boot", "firmware")
+        logging.info("Mounting boot partition on %s...", boot_mount_path)
+        os.makedirs(boot_mount_path, mode=0o755, exist_ok=True)
+        if not stack.enter_context(mounted(boot_partition, boot_mount_path, "vfat", MNT_OPTS_BOOT, failed_releases)):
+            logging.error("Failed to mount boot partition. Exiting.")
+            return 1
+
+        # Debootstrap
+        mirror = find_mirror()
+        logging.info("Creating minimal debootstrap system at %s...", mount_path)
+        if not debootstrap(mount_path, repo=mirror):
+            logging.error("debootstrap failed for %s. Exiting.", mount_path)
+            return 1
+
+        # System configuration
+        # TODO: Script keeps going if configuration fails, because cant pass variables btwn main script & chroot context
+        logging.info("Configuring system...")
+        with Chroot(mount_path):
+            # Swaps /etc/resolv.conf for a symlink, so it's done before apt-get update needs DNS
+            success = configure_networking()
+            if not success:
+                logging.error("Network configuration failed")
+
+            # These steps write separate files, so they run at the same time. apt-get
+            # update is the slowest by far, so it's submitted first to overlap the rest
+            if success:
+                steps = [
+                    ("Failed to configure apt", configure_apt, ()),
+                    ("Failed to write {}/etc/fstab".format(mount_path), write_fstab, (boot_partition_uuid, root_partition_uuid)),
+                    ("Failed to change root password", change_rootpw, ("toor",)),
+                    ("Locale configuration failed", configure_locale, ("en_US.UTF-8",)),
+                    ("Keyboard configuration failed", configure_keyboard, ("us",)),
+                    ("Vim configuration failed", configure_vim, ()),
+                    ("SSHD configuration failed", configure_sshd, ()),
+                    ("Hostname configuration failed", configure_hostname, ("raspberrypi",)),
+                    ("Failed to write {}".format(FILE_RESIZE_PART), write_file, (FILE_RESIZE_PART, SCRIPT_RESIZE_ROOTFS))
+                ]
+                results = run_parallel([(func, step_args) for _, func, step_args in steps])
+                for (error_msg, _, _), result in zip(steps, results):
+                    if not result:
+                        logging.error(error_msg)
+                        success = False
+
+            if not success:
+                logging.error("System configuration failed.")
+
+        # debootstrap leaves dpkg skipping fsync(), which the Pi shouldn't keep
+        if not dpkg_unsafe_io(mount_path, False):
+            logging.error("Failed to restore dpkg's safe I/O. Exiting.")
+            return 1
+
+    # The stack logs its own failures; don't touch an image that's still in use
+    if failed_releases:
+        logging.error("%s is still attached at %s. Exiting.", img_file, " ".join(failed_releases))
         return 1
 
-    # Delete image loop device
-    logging.info("Deleting loop device at {}".format(loop_device))
-    if not losetup_delete(loop_device):
-        logging.info("Failed to remove loop device {}. Exiting.".format(loop_device))
-        return 1
+    # mkfs & debootstrap write some blocks of zeros, e.g. the FAT; make them holes again
+    logging.info("Making %s sparse...", img_file)
+    if not dig_holes(img_file):
+        logging.warning("Failed to make %s sparse", img_file)
 
     logging.info("Done.")
     return 0
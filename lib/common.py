@@ -1,8 +1,24 @@
 import logging
+import os
+import shlex
 import subprocess as sp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 CMD_SYSTEMCTL_ENABLE = "systemctl enable {}"
 
+# Searched in order, like systemd's own unit path for the system manager
+DIRS_SYSTEMD_UNITS = ("/etc/systemd/system", "/lib/systemd/system")
+DIR_SYSTEMD_ENABLED = "/etc/systemd/system"
+# [Install] dependency keys and the directory suffix they're linked into
+SYSTEMD_INSTALL_DIRS = {"WantedBy": ".wants", "RequiredBy": ".requires"}
+
+# A named logger, so command output can be filtered apart from the rest of the build log
+logger = logging.getLogger(__name__)
+
+# Lines of streamed output kept to report when a command fails
+STREAM_ERROR_LINES = 20
+
 
 def read_file(path):
     """
@@ -13,15 +29,50 @@ def read_file(path):
     contents = None
 
     try:
-        logging.info("Reading {}...".format(path))
+        logger.info("Reading %s...", path)
         with open(path, encoding="utf-8") as f:
             contents = f.read()
     except Exception as e:
-        logging.warning("Error reading {}: {}".format(path, e))
+        logger.warning("Error reading %s: %s", path, e)
 
     return contents
 
 
+def _replace_file(path, contents):
+    """
+    Writes contents to a temporary file beside path, then renames it over
+    path so an interrupted write never leaves path truncated. An existing
+    file's mode and ownership are kept. Uses the raw fd rather than open()'s
+    buffered file object, which costs an fstat, ioctl and lseek per file
+    :param path: Path to write to
+    :param contents: Content to write
+    """
+    path = os.path.realpath(path)
+    tmp_path = "{}.tmp".format(path)
+    data = memoryview(contents.encode("utf-8"))
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o666)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            try:
+                path_stat = os.stat(path)
+            except FileNotFoundError:
+                path_stat = None
+            if path_stat is not None:
+                os.fchmod(fd, path_stat.st_mode & 0o7777)
+                os.fchown(fd, path_stat.st_uid, path_stat.st_gid)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 def write_file(path, contents, append=False):
     """
     Write contents to path
@@ -30,58 +81,223 @@ def write_file(path, contents, append=False):
     :param append: Whether to append the contents to the end of the file
     :return: Whether the operation was successful
     """
-    if append:
-        file_mode = "a"
-    else:
-        file_mode = "w"
     try:
-        logging.info("Writing {}...".format(path))
-        with open(path, file_mode, encoding="utf-8") as f:
-            f.write(contents)
+        logger.info("Writing %s...", path)
+        if append:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(contents)
+        else:
+            _replace_file(path, contents)
+    except Exception as e:
+        logger.warning("Error writing %s: %s", path, e)
+        return False
+
+    return True
+
+
+def write_files(files):
+    """
+    Write several files, stopping at the first failure
+    :param files: Dict of path to contents
+    :return: Whether every write was successful
+    """
+    for path, contents in files.items():
+        if not write_file(path, contents):
+            return False
+
+    return True
+
+
+def format_cmd(template, *args, **kwargs):
+    """
+    Formats each token of an argv template, so an argument containing spaces
+    stays a single argument instead of being split apart like a string
+    command would be
+    :param template: Tuple of argv tokens, e.g. ("umount", "{0}")
+    :return: argv list
+    """
+    return [token.format(*args, **kwargs) for token in template]
+
+
+def _run_cmd_streamed(cmd, input_text=None):
+    """
+    Runs cmd, logging its combined stdout and stderr line by line as it's
+    produced instead of holding all of it in memory until the command exits
+    :param cmd: argv list to run
+    :param input_text: Text to write to the command's stdin, or None
+    :return: Whether the command was successful
+    """
+    tail = deque(maxlen=STREAM_ERROR_LINES)
+    stdin = sp.PIPE if input_text is not None else None
+    try:
+        with sp.Popen(cmd, stdin=stdin, stdout=sp.PIPE, stderr=sp.STDOUT, text=True, errors="replace", bufsize=1) as process:
+            if input_text is not None:
+                process.stdin.write(input_text)
+                process.stdin.close()
+            for line in process.stdout:
+                line = line.rstrip()
+                logger.debug(line)
+                tail.append(line)
     except Exception as e:
-        logging.warning("Error writing {}: {}".format(path, e))
+        logger.error("Error running '%s': %s", " ".join(cmd), str(e).strip())
         return False
 
+    if process.returncode != 0:
+        logger.error("\n".join(tail))
+        return False
     return True
 
 
-def run_cmd(cmd, return_output=False):
+def run_cmd(cmd, return_output=False, input_text=None):
     """
     Runs the given cmd. If return_output, return stdout or None on error.
-    Else return a boolean indicating whether the operation was successful
-    :param cmd: Command to run
+    Else return a boolean indicating whether the operation was successful,
+    logging the command's output as it's produced rather than buffering all
+    of it. The command is exec'd directly rather than through /bin/sh, so it
+    can't use shell syntax
+    :param cmd: Command to run, either a string to split or an argv list
     :param return_output: Whether to return a string or boolean
-    :param chroot: Filesystem root for the command
+    :param input_text: Text to write to the command's stdin, e.g. secrets
+    that shouldn't show up in its argv
     :return: Stdout or boolean indicating if the operation was
     sucessful
     """
 
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+
+    if not return_output:
+        return _run_cmd_streamed(cmd, input_text)
+
     try:
         completed_process = sp.run(
             cmd,
-            shell=True,
+            input=input_text,
             stdout=sp.PIPE,
-            stderr=sp.PIPE
+            stderr=sp.PIPE,
+            text=True,
+            errors="replace"
         )
     except Exception as e:
-        logging.error("Error running '{}': {}".format(cmd, str(e).strip()))
-        if return_output:
-            return None
+        logger.error("Error running '%s': %s", " ".join(cmd), str(e).strip())
+        return None
+
+    if completed_process.returncode != 0:
+        logger.error(completed_process.stderr.strip())
+        return None
+
+    return completed_process.stdout.strip()
+
+
+def run_parallel(steps, max_workers=4):
+    """
+    Runs independent steps on a thread pool. Steps are expected to be
+    mostly subprocesses and file I/O, which release the GIL
+    :param steps: List of (function, args) tuples
+    :param max_workers: Maximum number of steps to run at once
+    :return: List of each step's return value, in the same order as steps
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, *args) for func, args in steps]
+    return [future.result() for future in futures]
+
+
+def _read_install_section(unit_path):
+    """
+    :param unit_path: Path to a systemd unit file
+    :return: Dict of the unit's [Install] keys to lists of values, or None if
+    it can't be read
+    """
+    contents = read_file(unit_path)
+    if contents is None:
+        return None
+
+    install = {}
+    section = None
+    for line in contents.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("["):
+            section = line.strip("[]")
+        elif section == "Install" and "=" in line:
+            key, _, value = line.partition("=")
+            install.setdefault(key.strip(), []).extend(value.split())
+
+    return install
+
+
+def _unit_links(unit, links, seen):
+    """
+    Adds the symlinks that 'systemctl enable' would create for unit, and for
+    the units its Also= names, to links
+    :param unit: Unit name, e.g. ssh.service
+    :param links: List of (target, link path) tuples to add to
+    :param seen: Set of units already visited
+    :return: False if the unit needs systemctl itself, e.g. a template, a
+    masked unit or an [Install] key that isn't handled here
+    """
+    if unit in seen:
+        return True
+    seen.add(unit)
+
+    if "@" in unit:
         return False
 
-    if not return_output:
-        logging.debug(completed_process.stdout.decode("utf-8").strip())
+    unit_paths = [os.path.join(unit_dir, unit) for unit_dir in DIRS_SYSTEMD_UNITS]
+    unit_path = next((path for path in unit_paths if os.path.lexists(path)), None)
+    # Masked units are symlinks to /dev/null
+    if unit_path is None or not os.path.isfile(unit_path):
+        return False
 
-    if completed_process.returncode != 0:
-        logging.error(completed_process.stderr.decode("utf-8").strip())
-        if return_output:
-            return None
+    install = _read_install_section(unit_path)
+    if install is None:
         return False
 
-    if return_output:
-        return completed_process.stdout.decode("utf-8").strip()
+    for key, values in install.items():
+        if any("%" in value for value in values):
+            return False
+        if key in SYSTEMD_INSTALL_DIRS:
+            for target in values:
+                link_dir = "{}{}".format(target, SYSTEMD_INSTALL_DIRS[key])
+                links.append((unit_path, os.path.join(DIR_SYSTEMD_ENABLED, link_dir, unit)))
+        elif key == "Alias":
+            for alias in values:
+                links.append((unit_path, os.path.join(DIR_SYSTEMD_ENABLED, alias)))
+        elif key == "Also":
+            for also in values:
+                if not _unit_links(also, links, seen):
+                    return False
+        else:
+            return False
+
     return True
 
 
 def systemd_enable(service_name):
-    return run_cmd(CMD_SYSTEMCTL_ENABLE.format(service_name))
+    """
+    Enables service_name by creating the symlinks its [Install] section asks
+    for, which is all 'systemctl enable' does offline, without starting
+    systemctl for each service. Units this can't handle fall back to
+    systemctl. Static units have no [Install] section and need nothing
+    :param service_name: Unit name, e.g. ssh or systemd-networkd.socket
+    :return: Whether the operation was successful
+    """
+    unit = service_name if "." in service_name else "{}.service".format(service_name)
+    links = []
+    if not _unit_links(unit, links, set()):
+        return run_cmd(CMD_SYSTEMCTL_ENABLE.format(service_name))
+
+    try:
+        for target, link in links:
+            os.makedirs(os.path.dirname(link), mode=0o755, exist_ok=True)
+            try:
+                os.symlink(target, link)
+            except FileExistsError:
+                if os.path.realpath(link) != os.path.realpath(target):
+                    raise
+    except OSError as e:
+        logger.error("Error enabling %s: %s", service_name, e)
+        return False
+
+    return True
@@ -1,40 +1,310 @@
-import re
-from .common import run_cmd
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import socket
+from urllib.parse import urlsplit
+from urllib.request import urlopen
 
-CMD_DEBOOTSTRAP = re.sub(r"\s+", " ", """
-    qemu-debootstrap
-        --arch={}
-        --keyring=/usr/share/keyrings/debian-archive-keyring.gpg
-        --components={}
-        --include={}
-        --variant={}
-        stable
-        {}
-        {}
-""").strip()
+from .common import format_cmd, run_cmd, write_file
 
+SUITE = "stable"
 
-def debootstrap(mnt_point, arch="arm64", components=("main", "contrib", "non-free"), extra_pks=(), variant="minbase", repo="http://ftp.debian.org/debian"):
+PKG_INCLUDES = (
+    "aptitude",
+    "dbus",
+    "dialog",
+    "dosfstools",
+    "firmware-brcm80211",
+    "firmware-realtek",
+    "iproute2",
+    "linux-image-arm64",
+    "locales",
+    "parted",
+    "python-apt",       # For ansible
+    "python",           # For ansible
+    "python-selinux",   # For ansible
+    "raspi3-firmware",
+    "rng-tools5",
+    "systemd",
+    "systemd-sysv",
+    "ssh",
+    "vim",
+    "wireless-tools",
+    "wpasupplicant"
+)
+
+# The first stage only unpacks, so it doesn't need to run target binaries
+CMD_DEBOOTSTRAP = (
+    "debootstrap",
+    "--foreign",
+    "--arch={arch}",
+    "--keyring=/usr/share/keyrings/debian-archive-keyring.gpg",
+    "--components={components}",
+    "--include={include}",
+    "--variant={variant}"
+)
+CMD_DEBOOTSTRAP_CACHE = "--cache-dir={}"
+CMD_DEBOOTSTRAP_SECOND_STAGE = ("chroot", "{0}", "/debootstrap/debootstrap", "--second-stage")
+
+# Excludes go between these, since tar applies them only to the paths after them
+CMD_TAR_CREATE = ("tar", "--zstd", "--numeric-owner", "--xattrs", "-cpf", "{0}", "-C", "{1}")
+CMD_TAR_CREATE_EXCLUDE = "--exclude=./{}"
+CMD_TAR_CREATE_PATH = "."
+CMD_TAR_EXTRACT = ("tar", "--zstd", "--numeric-owner", "--xattrs", "-xpf", "{0}", "-C", "{1}")
+
+MIRROR_DEFAULT = "http://deb.debian.org/debian"
+# docker-compose's nginx cache, then apt-cacher-ng's default port
+MIRROR_CACHES = (
+    "http://localhost:8080/debian",
+    "http://localhost:3142/debian"
+)
+MIRROR_PROBE_TIMEOUT = 1
+
+# What a suite like stable points to changes with every point and major release
+URL_RELEASE = "{}/dists/{}/Release"
+RELEASE_KEYS = ("Codename", "Date")
+RELEASE_TIMEOUT = 10
+
+# Debian arch to the qemu-user-static binary the second stage runs under
+QEMU_STATIC = {
+    "arm64": "qemu-aarch64-static",
+    "armhf": "qemu-arm-static",
+    "armel": "qemu-arm-static"
+}
+DIR_QEMU_STATIC = "usr/bin"
+
+# Stops dpkg from fsync()ing every file it unpacks. Only meant for the build
+FILE_DPKG_UNSAFE_IO = "etc/dpkg/dpkg.cfg.d/force-unsafe-io"
+CONFIG_DPKG_UNSAFE_IO = "force-unsafe-io\n"
+
+DIR_CACHE = "/var/cache/rasp-debootstrap"
+DIR_CACHE_DEBS = "debs"
+FILE_CACHE = "debootstrap-{}-{}.tar.zst"
+
+logger = logging.getLogger(__name__)
+
+
+def _release_id(repo):
+    """
+    Reads which release SUITE currently is from the header of repo's Release
+    file, e.g. ('bookworm', 'Sat, 06 Sep 2025 09:22:57 UTC')
+    :param repo: Debian mirror url
+    :return: Tuple of the RELEASE_KEYS values, or None on error
+    """
+    url = URL_RELEASE.format(repo, SUITE)
+    fields = {}
+    try:
+        with urlopen(url, timeout=RELEASE_TIMEOUT) as response:
+            for line in response:
+                line = line.decode("utf-8")
+                # The indented checksum lists that follow the header are most of the file
+                if line[:1].isspace():
+                    break
+                key, _, value = line.partition(":")
+                fields[key] = value.strip()
+    except (OSError, ValueError) as e:
+        logger.warning("Error reading %s: %s", url, e)
+        return None
+
+    if not all(key in fields for key in RELEASE_KEYS):
+        logger.warning("%s has no %s", url, " or ".join(RELEASE_KEYS))
+        return None
+    return tuple(fields[key] for key in RELEASE_KEYS)
+
+
+def _cache_path(cache_dir, release, arch, components, extra_pks, variant):
+    """
+    Builds the path of the cached root filesystem for the given release and
+    debootstrap options. The file name is a hash of them, so a new release
+    or changing any option makes a fresh cache entry rather than reusing a
+    stale one
+    :param cache_dir: Directory holding cached root filesystems
+    :param release: Release id from _release_id()
+    :return: Path to the cached tarball
+    """
+    key = repr((release, arch, sorted(components), sorted(set(extra_pks)), variant))
+    key = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, FILE_CACHE.format(arch, key))
+
+
+def find_mirror(candidates=MIRROR_CACHES, default=MIRROR_DEFAULT):
+    """
+    Picks the first local package cache that accepts connections, so repeat
+    builds download from local disk instead of the network
+    :param candidates: Mirror urls to try, in order of preference
+    :param default: Mirror to use if none of the candidates are up
+    :return: Mirror url
+    """
+    for url in candidates:
+        url_parts = urlsplit(url)
+        try:
+            socket.create_connection((url_parts.hostname, url_parts.port or 80), MIRROR_PROBE_TIMEOUT).close()
+        except OSError:
+            continue
+        logger.info("Using package cache at %s", url)
+        return url
+
+    logger.info("No package cache found, using %s", default)
+    return default
+
+
+def dpkg_unsafe_io(mnt_point, enable):
+    """
+    Turns dpkg's unsafe-io mode on or off for the system at mnt_point. Worth
+    it while the image is built, but a crash in it could corrupt a booted Pi
+    :param mnt_point: Root of the system to configure
+    :param enable: Whether dpkg should skip fsync()
+    :return: Whether the operation was successful
     """
-    Run debootrap at mnt_point
+    config_path = os.path.join(mnt_point, FILE_DPKG_UNSAFE_IO)
+    if enable:
+        os.makedirs(os.path.dirname(config_path), mode=0o755, exist_ok=True)
+        return write_file(config_path, CONFIG_DPKG_UNSAFE_IO)
+
+    try:
+        os.unlink(config_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error("Error removing %s: %s", config_path, e)
+        return False
+    return True
+
+
+def _copy_qemu_static(mnt_point, arch):
+    """
+    Copies the host's qemu-user-static binary for arch into mnt_point, which
+    is what qemu-debootstrap did. Only needed where binfmt_misc doesn't keep
+    the interpreter open itself
+    :param mnt_point: Root of the foreign system
+    :param arch: Debian architecture of the foreign system
+    """
+    qemu_path = shutil.which(QEMU_STATIC.get(arch, ""))
+    if qemu_path is None:
+        return
+
+    try:
+        shutil.copy2(qemu_path, os.path.join(mnt_point, DIR_QEMU_STATIC))
+    except OSError as e:
+        logger.warning("Error copying %s into %s: %s", qemu_path, mnt_point, e)
+
+
+def _build_only_files(arch):
+    """
+    :param arch: Debian architecture of the foreign system
+    :return: Paths, relative to the system's root, that debootstrap() adds
+    for the build rather than for the Pi. They're left out of the cache and
+    put back when it's unpacked
+    """
+    paths = [FILE_DPKG_UNSAFE_IO]
+    if arch in QEMU_STATIC:
+        paths.append(os.path.join(DIR_QEMU_STATIC, QEMU_STATIC[arch]))
+    return paths
+
+
+def _cache_system(mnt_point, arch, cache_path):
+    """
+    Archives the system at mnt_point to cache_path, then deletes the other
+    cached systems for arch, e.g. from older releases. A failure only means
+    the next build won't find a cache
+    :param mnt_point: Root of the bootstrapped system
+    :param arch: Debian architecture of the system
+    :param cache_path: Path from _cache_path()
+    """
+    # Write to a temporary name so an interrupted run never leaves a partial tarball behind
+    logger.info("Caching system at %s...", cache_path)
+    tmp_path = "{}.tmp".format(cache_path)
+    command = format_cmd(CMD_TAR_CREATE, tmp_path, mnt_point)
+    command += [CMD_TAR_CREATE_EXCLUDE.format(path) for path in _build_only_files(arch)]
+    command.append(CMD_TAR_CREATE_PATH)
+    cached = run_cmd(command)
+    if cached:
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning("Error renaming %s: %s", tmp_path, e)
+            cached = False
+
+    if not cached:
+        logger.warning("Failed to cache system at %s", cache_path)
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return
+
+    # Every release gets its own entry, so without this they'd pile up
+    old_paths = glob.glob(os.path.join(os.path.dirname(cache_path), FILE_CACHE.format(arch, "*")))
+    for old_path in old_paths:
+        if old_path == cache_path:
+            continue
+        logger.info("Deleting old system cache %s...", old_path)
+        try:
+            os.unlink(old_path)
+        except OSError as e:
+            logger.warning("Error deleting %s: %s", old_path, e)
+
+
+def debootstrap(mnt_point, arch="arm64", components=("main", "contrib", "non-free"), extra_pks=PKG_INCLUDES, variant="minbase", repo=MIRROR_DEFAULT, cache_dir=DIR_CACHE):
+    """
+    Run debootrap at mnt_point. If the same system was bootstrapped from the
+    same release before, it's unpacked from cache_dir instead. Otherwise
+    downloaded packages are kept in cache_dir for the next run
     :param mnt_point: Chroot for debootrap system
     :param arch: Chroot system architecture
     :param components: Debian components for Chroot packages
     :param extra_pks: Extra packages to install
     :param variant: Debootstrap variant to install
+    :param repo: Debian mirror to bootstrap from
+    :param cache_dir: Where to cache the bootstrapped system, or None to disable caching
     :return: Whether the operation was successful
     """
 
-    # Need debootstrap, debian-archive-keyring, qemu, binfmt-support, qemu-user-static
-    extra_pks = ",".join(extra_pks)
-    components = ",".join(components)
-    return run_cmd(
-        CMD_DEBOOTSTRAP.format(
-            arch,
-            components,
-            extra_pks,
-            variant,
-            mnt_point,
-            repo
-        )
+    # Need debootstrap, debian-archive-keyring, qemu, binfmt-support, qemu-user-static, zstd
+    # dpkg skips fsync() during the second stage, see dpkg_unsafe_io()
+    cache_path = None
+    cache_opts = []
+    if cache_dir is not None:
+        release = _release_id(repo)
+        if release is None:
+            logger.warning("Can't tell which release %s is, so the system won't be cached", SUITE)
+        else:
+            cache_path = _cache_path(cache_dir, release, arch, components, extra_pks, variant)
+
+        if cache_path is not None and os.path.exists(cache_path):
+            logger.info("Unpacking cached system from %s...", cache_path)
+            if not run_cmd(format_cmd(CMD_TAR_EXTRACT, cache_path, mnt_point)):
+                return False
+            _copy_qemu_static(mnt_point, arch)
+            return dpkg_unsafe_io(mnt_point, True)
+
+        debs_dir = os.path.join(cache_dir, DIR_CACHE_DEBS)
+        try:
+            os.makedirs(debs_dir, mode=0o755, exist_ok=True)
+            cache_opts = [CMD_DEBOOTSTRAP_CACHE.format(debs_dir)]
+        except OSError as e:
+            logger.warning("Error creating %s, so nothing will be cached: %s", debs_dir, e)
+            cache_path = None
+
+    command = format_cmd(
+        CMD_DEBOOTSTRAP,
+        arch=arch,
+        components=",".join(components),
+        include=",".join(sorted(set(extra_pks))),
+        variant=variant
     )
+    command += cache_opts + [SUITE, mnt_point, repo]
+
+    # The second stage is what runs dpkg, so unsafe-io goes in between the two
+    success = run_cmd(command) and dpkg_unsafe_io(mnt_point, True)
+
+    if success:
+        _copy_qemu_static(mnt_point, arch)
+        success = run_cmd(format_cmd(CMD_DEBOOTSTRAP_SECOND_STAGE, mnt_point))
+
+    if success and cache_path is not None:
+        _cache_system(mnt_point, arch, cache_path)
+
+    return success
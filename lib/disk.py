@@ -1,52 +1,157 @@
+import ctypes
+import ctypes.util
+import fcntl
+import glob
 import logging
-from .common import run_cmd
+import os
+import stat
+import struct
+import time
+from contextlib import contextmanager
 
-CMD_DD = "dd if={} of={}"
-CMD_DD_COUNT = "dd if={} of={} iflag=fullblock bs={} count={}"
+from .common import format_cmd, run_cmd
 
-CMD_PART_CREATE = "parted -s -a optimal {} mkpart primary {} {} {}"
-CMD_PART_TBL_CREATE = "parted -s {} mklabel msdos"
+# Commands taking the image file or mount point, which come from the command
+# line, are argv tuples for format_cmd so paths with spaces survive
+CMD_DD = ("dd", "if={0}", "of={1}", "status=none")
+CMD_DD_COUNT = ("dd", "if={0}", "of={1}", "iflag=fullblock", "bs={2}", "count={3}", "status=none")
+
+CMD_DIG_HOLES = ("fallocate", "--dig-holes", "{0}")
+
+CMD_MKFS = "mkfs.{} {} {}"
+
+CMD_PART_DISK = "parted -s -a optimal {} mklabel msdos {}"
+CMD_PART_DISK_MKPART = "mkpart primary {} {} {}"
 CMD_PART_UUID = "lsblk {} -n -o UUID"
 
-CMD_LOOP_DEV_CREATE = "losetup --show -P -f {}"
+CMD_LOOP_DEV_CREATE = ("losetup", "--show", "-P", "-f", "{0}")
+CMD_LOOP_DEV_CREATE_DIRECT = ("losetup", "--show", "-P", "-f", "--direct-io=on", "{0}")
 CMD_LOOP_DEV_DELETE = "losetup -d {}"
 
-CMD_MNT = "mount {} {}"
-CMD_UMNT = "umount {}"
+# Partition nodes show up asynchronously after the partition table is written
+DEVICE_WAIT_TIMEOUT = 5
+DEVICE_WAIT_INTERVAL = 0.05
+
+DIR_SYS_BLOCK = "/sys/block"
+
+# Set to go through mount/umount binaries instead of the syscalls, e.g. for debugging
+ENV_MOUNT_SUBPROCESS = "RPI_MOUNT_SUBPROCESS"
+
+# From linux/loop.h
+FILE_LOOP_CONTROL = "/dev/loop-control"
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_PARTSCAN = 8
+LO_NAME_SIZE = 64
+# struct loop_info64
+LOOP_INFO64 = struct.Struct("=5Q4I64s64s32s2Q")
+
+# From linux/mount.h, as (flags to set, flags to clear) like mount(8), so a
+# later option overrides an earlier one. Options that only mean something to
+# mount(8) or fstab map to nothing. Any other mount option is passed to the
+# filesystem as data
+MOUNT_FLAGS = {
+    "ro": (1, 0),
+    "rw": (0, 1),
+    "nosuid": (2, 0),
+    "suid": (0, 2),
+    "nodev": (4, 0),
+    "dev": (0, 4),
+    "noexec": (8, 0),
+    "exec": (0, 8),
+    "sync": (16, 0),
+    "async": (0, 16),
+    "noatime": (1024, 0),
+    "atime": (0, 1024),
+    "nodiratime": (2048, 0),
+    "diratime": (0, 2048),
+    "relatime": (1 << 21, 0),
+    "norelatime": (0, 1 << 21),
+    "defaults": (0, 0),
+    "auto": (0, 0),
+    "noauto": (0, 0),
+    "nouser": (0, 0),
+    "nofail": (0, 0)
+}
+
+CMD_MNT = ("mount", "{0}", "{1}")
+CMD_MNT_OPTS = ("mount", "-o", "{0}", "{1}", "{2}")
+CMD_UMNT = ("umount", "{0}")
 
 CMD_PVCREATE = "pvcreate {}"
 CMD_VGCREATE = "vgcreate {} {}"
 CMD_LVCREATE = "lvcreate -n {} -L {} {}"
 
-SUPPORTED_PART_TYPES = ["fat32", "ext4"]
-SUPPORTED_FS_TYPES = ["vfat", "ext4"]
+SUPPORTED_PART_TYPES = frozenset(("fat32", "ext4"))
+SUPPORTED_FS_TYPES = frozenset(("vfat", "ext4"))
+
+# A freshly created sparse image has nothing to discard, so skip mkfs.ext4's
+# hole-punching discard pass. lazy_itable_init leaves zeroing the inode tables
+# to the kernel's ext4lazyinit thread after mount. lazy_journal_init skips
+# zeroing the journal altogether, which is only safe because the image starts
+# out sparse and so already reads back as zeros. mkfs.fat has neither to skip
+MKFS_OPTIONS = {
+    "vfat": "",
+    "ext4": "-F -E nodiscard,lazy_itable_init=1,lazy_journal_init=1"
+}
 
+logger = logging.getLogger(__name__)
 
-def create_partition_table(block_dev):
+
+def partition_disk(block_dev, partitions):
     """
-    Creates an msdos partition table on the given block_dev
+    Creates an msdos partition table and the given partitions on block_dev
+    with a single parted run
     :param block_dev: Block device to partition
+    :param partitions: List of (part_type, start, end) tuples. part_type is
+    'fat32' or 'ext4', start and end are percentages or bytes
     :return: Whether the operation was successful
     """
-    return run_cmd(CMD_PART_TBL_CREATE.format(block_dev))
+    for part_type, _, _ in partitions:
+        if part_type not in SUPPORTED_PART_TYPES:
+            logger.error(
+                "Error partitioning %s: Invalid partition type '%s'", block_dev, part_type
+            )
+            logger.error("Valid entries are %s", " ".join(sorted(SUPPORTED_PART_TYPES)))
+            return False
+
+    mkparts = " ".join(CMD_PART_DISK_MKPART.format(*partition) for partition in partitions)
+    return run_cmd(CMD_PART_DISK.format(block_dev, mkparts))
 
 
-def create_partition(block_dev, part_type, start, end):
+def wait_for_devices(dev_paths, timeout=DEVICE_WAIT_TIMEOUT):
     """
-    Runs 'parted -s -a optimal block_dev mkpart primary fstype start end'
-    :param block_dev: Block device to create partition on
-    :param part_type: Filesystem type; 'fat32' or 'ext4' only
-    :param start: Percentage or bytes
-    :param end: Percentage or bytes
-    :return: Whether the operation was successful
+    Waits for block device nodes to appear, e.g. a loop device's partitions
+    after partitioning it. Polls rather than sleeping a fixed time, so the
+    common case of the nodes already being there costs nothing
+    :param dev_paths: Block device paths to wait for
+    :param timeout: Seconds to wait before giving up
+    :return: Whether all the devices appeared in time
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(dev_paths)
+    while True:
+        pending = [dev_path for dev_path in pending if not _is_block_device(dev_path)]
+        if not pending:
+            return True
+        if time.monotonic() >= deadline:
+            logger.error("Timed out waiting for %s", " ".join(pending))
+            return False
+        time.sleep(DEVICE_WAIT_INTERVAL)
+
+
+def _is_block_device(path):
+    """
+    :param path: Path to check
+    :return: Whether path exists and is a block device
     """
-    if not part_type in SUPPORTED_PART_TYPES:
-        logging.error(
-            "Error partitioning {}: Invalid partition type '{}'".format(block_dev, part_type)
-        )
-        logging.error("Valid entries are {}".format(" ".join(SUPPORTED_PART_TYPES)))
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
         return False
-    return run_cmd(CMD_PART_CREATE.format(block_dev, part_type, start, end))
 
 
 def dd(input_file, output_file, block_bytes=512, block_count=0):
@@ -59,46 +164,285 @@ def dd(input_file, output_file, block_bytes=512, block_count=0):
     :return: Whether the operation was successful
     """
     if block_count > 0:
-        command = CMD_DD_COUNT.format(input_file, output_file, block_bytes, block_count)
+        command = format_cmd(CMD_DD_COUNT, input_file, output_file, block_bytes, block_count)
     else:
-        command = CMD_DD.format(input_file, output_file)
+        command = format_cmd(CMD_DD, input_file, output_file)
     return run_cmd(command)
 
 
-def mount_device(dev_path, mnt_path):
+def create_sparse_file(file_name, size_mb):
     """
-    Runs 'mount dev_path mnt_path'
+    Creates file_name as a sparse file of size_mb megabytes. Only the file
+    size is set, without writing any data like dd from /dev/zero would, and
+    blocks are allocated as they're written
+    :param file_name: File to create
+    :param size_mb: Size of the file in megabytes
+    :return: Whether the operation was successful
+    """
+    try:
+        fd = os.open(file_name, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size_mb << 20)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.error("Error creating %s: %s", file_name, e)
+        return False
+
+    return True
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def _load_libblkid():
+    """
+    :return: libblkid with the low-level probe functions' signatures set, or
+    None if it isn't installed
+    """
+    lib_path = ctypes.util.find_library("blkid")
+    if lib_path is None:
+        return None
+
+    libblkid = ctypes.CDLL(lib_path)
+    libblkid.blkid_new_probe_from_filename.argtypes = [ctypes.c_char_p]
+    libblkid.blkid_new_probe_from_filename.restype = ctypes.c_void_p
+    libblkid.blkid_do_safeprobe.argtypes = [ctypes.c_void_p]
+    libblkid.blkid_probe_lookup_value.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.POINTER(ctypes.c_char_p),
+        ctypes.POINTER(ctypes.c_size_t)
+    ]
+    libblkid.blkid_free_probe.argtypes = [ctypes.c_void_p]
+    libblkid.blkid_free_probe.restype = None
+    return libblkid
+
+
+_libblkid = _load_libblkid()
+
+
+def _is_mount_point_path(path):
+    """
+    :param path: Path passed to unmount_device
+    :return: Whether path is an existing file or directory rather than a device or tag
+    """
+    try:
+        return not stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def dig_holes(file_name):
+    """
+    Deallocates the all-zero blocks of file_name, making it sparse. The
+    contents read back the same, but the unused parts of an image stop
+    taking up disk space
+    :param file_name: File to make sparse
+    :return: Whether the operation was successful
+    """
+    return run_cmd(format_cmd(CMD_DIG_HOLES, file_name))
+
+
+def _mount_flags(options):
+    """
+    Splits mount options into mount(2) flags and filesystem data
+    :param options: Comma separated mount options, or None
+    :return: (flags, data) tuple. data is None if there is none
+    """
+    flags = 0
+    data = []
+    for option in (options or "").split(","):
+        if option in MOUNT_FLAGS:
+            set_flags, clear_flags = MOUNT_FLAGS[option]
+            flags = (flags & ~clear_flags) | set_flags
+        elif option:
+            data.append(option)
+
+    return flags, ",".join(data).encode() if data else None
+
+
+def mount_device(dev_path, mnt_path, fs_type=None, options=None):
+    """
+    Mounts dev_path on mnt_path. When fs_type is given this is a single
+    mount(2) call, otherwise it runs 'mount dev_path mnt_path' so mount can
+    probe the filesystem
     :param dev_path: Path to block device to mount
     :param mnt_path: Path to mount on
+    :param fs_type: Filesystem type of dev_path
+    :param options: Comma separated mount options, as for 'mount -o'
     :return: Whether the operation was successful
     """
-    return run_cmd(CMD_MNT.format(dev_path, mnt_path))
+    if fs_type is None or os.environ.get(ENV_MOUNT_SUBPROCESS):
+        if options:
+            return run_cmd(format_cmd(CMD_MNT_OPTS, options, dev_path, mnt_path))
+        return run_cmd(format_cmd(CMD_MNT, dev_path, mnt_path))
+
+    flags, data = _mount_flags(options)
+    if _libc.mount(dev_path.encode(), mnt_path.encode(), fs_type.encode(), ctypes.c_ulong(flags), data) != 0:
+        logger.error("Error mounting %s on %s: %s", dev_path, mnt_path, os.strerror(ctypes.get_errno()))
+        return False
+
+    return True
 
 
 def unmount_device(dev_or_mount_path):
     """
+    Unmounts a mount point with umount2(2), or runs 'umount' for devices
+    and tags since the syscall only accepts mount points
     :param dev_or_mount_path: Filesystem or block device path to unmount
     :return: Whether the operation was successful
     """
-    return run_cmd(CMD_UMNT.format(dev_or_mount_path))
+    if not _is_mount_point_path(dev_or_mount_path) or os.environ.get(ENV_MOUNT_SUBPROCESS):
+        return run_cmd(format_cmd(CMD_UMNT, dev_or_mount_path))
+
+    if _libc.umount2(dev_or_mount_path.encode(), 0) != 0:
+        logger.error("Error unmounting %s: %s", dev_or_mount_path, os.strerror(ctypes.get_errno()))
+        return False
+
+    return True
+
+
+@contextmanager
+def mounted(dev_path, mnt_path, fs_type=None, options=None, failed_releases=None):
+    """
+    Mounts dev_path at mnt_path for the duration of a with block
+    :param dev_path: Device path to mount
+    :param mnt_path: Mount point
+    :param fs_type: Filesystem type of dev_path
+    :param options: Comma separated mount options
+    :param failed_releases: List to append mnt_path to if it can't be unmounted
+    :return: Whether the mount was successful
+    """
+    if not mount_device(dev_path, mnt_path, fs_type, options):
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        logger.info("Unmounting %s...", mnt_path)
+        if not unmount_device(mnt_path):
+            logger.error("Failed to unmount %s", mnt_path)
+            if failed_releases is not None:
+                failed_releases.append(mnt_path)
 
 
 def get_partition_uuid(dev_path):
     """
-    Gets the filesystem uuid for the device at dev_path
+    Gets the filesystem uuid for the device at dev_path. libblkid probes the
+    device itself, where lsblk reads the udev database, which can still be
+    empty right after mkfs
     :param dev_path: Path to device
     :return: The uuid or None on error
     """
-    return run_cmd(CMD_PART_UUID.format(dev_path), return_output=True)
+    if _libblkid is None:
+        return run_cmd(CMD_PART_UUID.format(dev_path), return_output=True) or None
+
+    probe = _libblkid.blkid_new_probe_from_filename(dev_path.encode())
+    if not probe:
+        logger.error("Error opening %s to read its uuid", dev_path)
+        return None
+
+    try:
+        value = ctypes.c_char_p()
+        if (_libblkid.blkid_do_safeprobe(probe) != 0 or
+                _libblkid.blkid_probe_lookup_value(probe, b"UUID", ctypes.byref(value), None) != 0):
+            logger.error("No filesystem uuid found on %s", dev_path)
+            return None
+        return value.value.decode()
+    finally:
+        _libblkid.blkid_free_probe(probe)
+
+
+def _losetup_ioctl(file_name, direct_io):
+    """
+    Does the work of 'losetup --show -P -f' with loop ioctls instead of
+    running losetup
+    :param file_name: File name to mount as a loop device
+    :param direct_io: Whether to bypass the host page cache for the backing file
+    :return: The name of the loop device created
+    :raises OSError: If any ioctl fails, after detaching the loop device
+    """
+    ctl_fd = os.open(FILE_LOOP_CONTROL, os.O_RDWR)
+    try:
+        loop_dev = "/dev/loop{}".format(fcntl.ioctl(ctl_fd, LOOP_CTL_GET_FREE))
+    finally:
+        os.close(ctl_fd)
+
+    file_fd = os.open(file_name, os.O_RDWR)
+    try:
+        loop_fd = os.open(loop_dev, os.O_RDWR)
+        try:
+            fcntl.ioctl(loop_fd, LOOP_SET_FD, file_fd)
+            try:
+                loop_info = LOOP_INFO64.pack(
+                    0, 0, 0, 0, 0,
+                    0, 0, 0, LO_FLAGS_PARTSCAN,
+                    os.path.abspath(file_name).encode("utf-8")[:LO_NAME_SIZE - 1], b"", b"",
+                    0, 0
+                )
+                fcntl.ioctl(loop_fd, LOOP_SET_STATUS64, loop_info)
+            except OSError:
+                fcntl.ioctl(loop_fd, LOOP_CLR_FD)
+                raise
 
+            if direct_io:
+                try:
+                    fcntl.ioctl(loop_fd, LOOP_SET_DIRECT_IO, 1)
+                except OSError as e:
+                    # Same as losetup: the backing filesystem may not support O_DIRECT
+                    logger.warning("Direct I/O unavailable for %s: %s", loop_dev, e)
+        finally:
+            os.close(loop_fd)
+    finally:
+        os.close(file_fd)
 
-def losetup_create(file_name):
+    return loop_dev
+
+
+def losetup_create(file_name, direct_io=True):
     """
-    Mounts an image file as a loop device
+    Mounts an image file as a loop device. With direct_io, the loop driver
+    writes straight to the backing file instead of caching the image's pages
+    a second time in the host page cache. This only pays off when the image
+    is large relative to free RAM, but costs nothing otherwise
     :param file_name: File name to mount as a loop device
+    :param direct_io: Whether to bypass the host page cache for the backing file
     :return: The name of the loop device created or None on error
     """
-    return run_cmd(CMD_LOOP_DEV_CREATE.format(file_name), return_output=True)
+    try:
+        return _losetup_ioctl(file_name, direct_io)
+    except OSError as e:
+        logger.debug("Loop ioctls failed for %s, falling back to losetup: %s", file_name, e)
+
+    if direct_io:
+        loop_dev = run_cmd(format_cmd(CMD_LOOP_DEV_CREATE_DIRECT, file_name), return_output=True)
+        if loop_dev is not None:
+            return loop_dev
+        # util-linux older than 2.28 doesn't know --direct-io and fails before attaching anything
+        logger.warning("Retrying losetup for %s without direct I/O", file_name)
+
+    return run_cmd(format_cmd(CMD_LOOP_DEV_CREATE, file_name), return_output=True)
+
+
+def get_loop_devices():
+    """
+    Lists the attached loop devices by reading sysfs, rather than running and
+    parsing 'losetup -a'
+    :return: Dict of backing file path to loop device path
+    """
+    loop_devs = {}
+    for sys_path in glob.glob(os.path.join(DIR_SYS_BLOCK, "loop*")):
+        try:
+            with open(os.path.join(sys_path, "loop", "backing_file"), encoding="utf-8") as f:
+                backing_file = f.read().strip()
+        except OSError:
+            # Not attached to anything
+            continue
+        loop_devs[backing_file] = os.path.join("/dev", os.path.basename(sys_path))
+
+    return loop_devs
 
 
 def losetup_delete(loop_dev):
@@ -110,6 +454,29 @@ def losetup_delete(loop_dev):
     return run_cmd(CMD_LOOP_DEV_DELETE.format(loop_dev))
 
 
+@contextmanager
+def loop_device(file_name, failed_releases=None):
+    """
+    Attaches file_name to a loop device for the duration of a with block
+    :param file_name: File name to mount as a loop device
+    :param failed_releases: List to append the loop device to if it can't be detached
+    :return: The loop device path or None on error
+    """
+    loop_dev = losetup_create(file_name)
+    if loop_dev is None:
+        yield None
+        return
+
+    try:
+        yield loop_dev
+    finally:
+        logger.info("Deleting loop device at %s...", loop_dev)
+        if not losetup_delete(loop_dev):
+            logger.error("Failed to remove loop device %s", loop_dev)
+            if failed_releases is not None:
+                failed_releases.append(loop_dev)
+
+
 def format_partition(dev_path, fs_type):
     """
     Formats the partition at dev_path using fs_type
@@ -119,10 +486,10 @@ def format_partition(dev_path, fs_type):
     """
     # These are all we need for the PI and is a good sanity check
     if fs_type not in SUPPORTED_FS_TYPES:
-        logging.error("{} is not a valid filesystem type".format(fs_type))
-        logging.error("Supported values are: ".format(SUPPORTED_FS_TYPES))
+        logger.error("%s is not a valid filesystem type", fs_type)
+        logger.error("Supported values are: %s", " ".join(sorted(SUPPORTED_FS_TYPES)))
         return False
-    return run_cmd("mkfs.{} {}".format(fs_type, dev_path))
+    return run_cmd(CMD_MKFS.format(fs_type, MKFS_OPTIONS[fs_type], dev_path))
 
 
 def create_physical_volume(dev_path):
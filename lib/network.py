@@ -1,8 +1,8 @@
 import logging
 import os
-import re
+import shutil
 
-from lib.common import systemd_enable, write_file, read_file, run_cmd
+from lib.common import systemd_enable, write_file, write_files
 from lib.disk import unmount_device
 
 CONFIG_DHCP = """
@@ -11,12 +11,12 @@ Name=*
 
 [Network]
 DHCP=ipv4
-"""
+""".lstrip()
 
 CONFIG_HOSTS = """
 127.0.0.1    localhost
 127.0.1.1    {}
-"""
+""".lstrip()
 
 DIR_RESOLVCONF = "/run/systemd/resolve"
 
@@ -27,7 +27,7 @@ FILE_NETWORKD_DEFAULT = "/etc/systemd/network/99-default.network"
 FILE_RESOLVCONF_RUN = "/run/systemd/resolve/resolv.conf"
 FILE_RESOLVCONF_ETC = "/etc/resolv.conf"
 
-FILE_SSHD = "/etc/ssh/sshd_config"
+logger = logging.getLogger(__name__)
 
 
 def configure_hostname(hostname):
@@ -36,10 +36,10 @@ def configure_hostname(hostname):
     :param hostname: Hostname
     :return: Whether the operation was successful
     """
-    return (
-        write_file(FILE_HOSTNAME, "{}\n".format(hostname)) and
-        write_file(FILE_HOSTS, CONFIG_HOSTS.format(hostname))
-    )
+    return write_files({
+        FILE_HOSTNAME: "{}\n".format(hostname),
+        FILE_HOSTS: CONFIG_HOSTS.format(hostname)
+    })
 
 
 def configure_networking():
@@ -52,52 +52,32 @@ def configure_networking():
     success = systemd_enable("dbus")
 
     if success:
-        logging.info("Configuring systemd-networkd...")
+        logger.info("Configuring systemd-networkd...")
         success = (
             write_file(FILE_NETWORKD_DEFAULT, CONFIG_DHCP) and
             success and systemd_enable("systemd-networkd")
         )
 
     if success:
-        logging.info("Configuring systemd-resolved...")
+        logger.info("Configuring systemd-resolved...")
         try:
             os.makedirs(DIR_RESOLVCONF, mode=0o755, exist_ok=True)
-            success = (
-                run_cmd("cp {} {}".format(FILE_RESOLVCONF_ETC, FILE_RESOLVCONF_RUN)) and
-                unmount_device(FILE_RESOLVCONF_ETC)
-            )
+            # Keep the host's resolver for the rest of the build, via the symlink below
+            shutil.copyfile(FILE_RESOLVCONF_ETC, FILE_RESOLVCONF_RUN)
+            success = unmount_device(FILE_RESOLVCONF_ETC)
             os.remove(FILE_RESOLVCONF_ETC)
         except Exception as e:
-            logging.error("Error copying systemd-resolved files: {}".format(e))
+            logger.error("Error copying systemd-resolved files: %s", e)
             success = False
 
         if success:
             try:
                 os.symlink(FILE_RESOLVCONF_RUN, FILE_RESOLVCONF_ETC)
             except Exception as e:
-                logging.error("Error symlinking resolvconf: {}".format(e))
+                logger.error("Error symlinking resolvconf: %s", e)
                 success = False
 
         if success:
             success = systemd_enable("systemd-resolved")
 
-        if success:
-            ssh_config = read_file(FILE_SSHD)
-            try:
-                ssh_config = re.sub(
-                    r"# +(?=PermitRootLogin\s+yes|no|prohibit-password)$",
-                    "",
-                    ssh_config,
-                    re.MULTILINE
-                )
-            except Exception as e:
-                logging.error("Error formatting ssh config: {}".format(e))
-                success = False
-
-            if success:
-                success = (
-                    write_file(FILE_SSHD, ssh_config) and
-                    systemd_enable("ssh")
-                )
-
     return success
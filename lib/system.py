@@ -1,30 +1,35 @@
-import crypt
-import re
-
-from lib.common import run_cmd, read_file, write_file
+from lib.common import run_cmd, read_file, write_file, write_files, systemd_enable
 
 CONFIG_APT_SUGGESTS = """
 APT::Install-Recommends "false";
 APT::Install-Suggested "false";
-""".strip()
+""".lstrip()
 
+# Tab separated, since the UUIDs' lengths differ between vfat and ext4
 CONFIG_FSTAB = """
-/dev/mmcblk0p1          /boot/firmware  vfat    defaults            0 2
-/dev/mmcblk1p2          /               ext4    defaults,noatime    0 1
-proc                    /proc           proc    defaults            0 0
-""".strip()
+UUID={0}	/boot/firmware	vfat	defaults	0	2
+UUID={1}	/	ext4	defaults,noatime	0	1
+proc	/proc	proc	defaults	0	0
+""".lstrip()
 
 CONFIG_LANG = """
 LANG="{0}"
-""".strip()
+""".lstrip()
+
+# What the locales package's debconf answers would write
+CONFIG_LOCALE_GEN = """
+{0} {1}
+""".lstrip()
 
 CONFIG_KEYBOARD = """
-XKBMODEL={}
-XKBLAYOUT={}
-XKBVARIANT={}
-XKBOPTIONS={}
-BACKSPACE={}
-""".strip()
+XKBMODEL="{}"
+XKBLAYOUT="{}"
+XKBVARIANT="{}"
+XKBOPTIONS="{}"
+BACKSPACE="{}"
+""".lstrip()
+
+CONFIG_SSHD_ROOT_LOGIN = "PermitRootLogin yes\n"
 
 CONFIG_VIM = """
 syntax on
@@ -36,44 +41,77 @@ set expandtab
 
 autocmd FileType make setlocal noexpandtab
 autocmd FileType yaml setlocal ts=2 sts=2 sw=2 expandtab
-""".strip()
+""".lstrip()
 
-CMD_KERNEL_INSTALL = "apt-get install -y linux-image-arm64"
+CMD_LOCALE_GEN = "locale-gen"
+CMD_CHPASSWD = "chpasswd"
 
 FILE_APT_SOURCES = "/etc/apt/sources.list"
 FILE_APT_CONFIG = "/etc/apt/apt.conf.d/99disable-suggested"
 FILE_FSTAB = "/etc/fstab"
 FILE_KEYBOARD = "/etc/default/keyboard"
 FILE_LOCALES = "/etc/default/locale"
-FILE_PASSWD = "/etc/shadow"
+FILE_LOCALE_GEN = "/etc/locale.gen"
 FILE_VIMRC = "/etc/vim/vimrc"
 FILE_SSHD = "/etc/ssh/sshd_config"
 
 
 def configure_sshd():
     """
-    Configures SSHD to allow root logins
+    Configures SSHD to allow root logins and enables it. Top-level
+    PermitRootLogin lines, commented out or not, are replaced in a single
+    pass over the file. If there are none, the setting goes before the first
+    Match block, since anything after one only applies inside it
     :return: Whether the operation was successful
     """
     sshd_config = read_file(FILE_SSHD)
-    re.sub(
-        r"^#?\s*PermitRootLogin\s+(no|prohibit-password)$",
-        "PermitRootLogin yes",
-        sshd_config,
-        flags=re.MULTILINE
+    if sshd_config is None:
+        return False
+
+    lines = []
+    found = False
+    in_match = False
+    for line in sshd_config.splitlines(keepends=True):
+        keyword = line.split()[:1]
+        if keyword and keyword[0].lower() == "match":
+            if not in_match and not found:
+                lines.append(CONFIG_SSHD_ROOT_LOGIN)
+                found = True
+            in_match = True
+        # An indented line, even a commented-out one, is an example for a Match block
+        elif (not in_match and not line[:1].isspace() and not line.lstrip("#").startswith("\t") and
+                line.lstrip("# ").split()[:1] == ["PermitRootLogin"]):
+            line = CONFIG_SSHD_ROOT_LOGIN
+            found = True
+        lines.append(line)
+
+    if not found:
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        lines.append(CONFIG_SSHD_ROOT_LOGIN)
+
+    return (
+        write_file(FILE_SSHD, "".join(lines)) and
+        systemd_enable("ssh")
     )
-    return write_file(FILE_SSHD, sshd_config)
 
 
 def configure_locale(locale):
     """
-    Configure /etc/default/locale
-    :param locale: Locale
+    Configure /etc/default/locale and generate locale. Debian's locale-gen
+    only builds what /etc/locale.gen lists, so that's written directly
+    rather than through debconf and dpkg-reconfigure
+    :param locale: Locale, e.g. en_US.UTF-8
     :return: Whether the operation was successful
     """
+    # glibc's default charset for locales without one, e.g. en_US
+    charset = locale.partition(".")[2] or "ISO-8859-1"
     return (
-        write_file(FILE_LOCALES, CONFIG_LANG.format(locale)) and
-        run_cmd("locale-gen --purge {}".format(locale))
+        write_files({
+            FILE_LOCALE_GEN: CONFIG_LOCALE_GEN.format(locale, charset),
+            FILE_LOCALES: CONFIG_LANG.format(locale)
+        }) and
+        run_cmd(CMD_LOCALE_GEN)
     )
 
 
@@ -111,9 +149,11 @@ def configure_apt(url="http://deb.debian.org/debian", distrib="stable", componen
         " ".join(components)
     )
     return (
-            write_file(FILE_APT_CONFIG, CONFIG_APT_SUGGESTS) and
-            write_file(FILE_APT_SOURCES, sources_content) and
-            run_cmd("apt-get update")
+        write_files({
+            FILE_APT_CONFIG: CONFIG_APT_SUGGESTS,
+            FILE_APT_SOURCES: sources_content
+        }) and
+        run_cmd("apt-get update")
     )
 
 
@@ -127,28 +167,14 @@ def write_fstab(boot_uuid, root_uuid):
     return write_file(FILE_FSTAB, CONFIG_FSTAB.format(boot_uuid, root_uuid))
 
 
-def install_kernel():
-    """
-    Installs the Debian Arm64 kernel package
-    :return: Whether the operation was successful
-    """
-    return run_cmd(CMD_KERNEL_INSTALL)
-
-
 def change_rootpw(passwd):
     """
-    Changes the system root password
+    Changes the system root password. chpasswd locks and replaces
+    /etc/shadow itself and hashes with the system's default ENCRYPT_METHOD
     :param passwd: New root password
     :return: Whether the operation was successful
     """
-    shadow_contents = read_file(FILE_PASSWD)
-    if shadow_contents is not None:
-        shadow_contents = re.sub(
-            r"(?<=^root:)\*(?=:)",
-            crypt.crypt(passwd, salt=crypt.METHOD_SHA256),
-            shadow_contents
-        )
-        return write_file(FILE_PASSWD, shadow_contents)
+    return run_cmd(CMD_CHPASSWD, input_text="root:{}\n".format(passwd))
 
 
 def configure_vim():